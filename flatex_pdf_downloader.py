@@ -4,25 +4,51 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import json
 import logging
+import logging.handlers
+import random
 import sys
-import time
+from collections.abc import Awaitable
 from datetime import datetime
 from pathlib import Path
-
-from playwright.sync_api import Page, sync_playwright
-
-from src.download import save_pdf_from_link
-from src.parse_utils import extract_pdf_link_from_script
+from urllib.parse import urlparse
+
+import httpx
+from playwright.async_api import Page, async_playwright
+
+from src.download import (
+    RETRIABLE_STATUSES,
+    CircuitBreaker,
+    build_http_client,
+    list_output_names,
+    prewarm_connection,
+    save_pdf_from_link,
+    sweep_partial_files,
+)
+from src.page_scripts import install_page_helpers
+from src.parse_utils import PDF_LINK_PATTERN, build_stable_stem, filename_from_url
+from src.resume import RESUME_LOG_NAME, ResumeLog, row_keys
 
 ROW_SELECTOR = 'tr[onclick^="DocumentViewer.openPopupIfRequired"]'
+ROW_FETCH_PARALLELISM = 8
+EXPIRED_LINK_STATUSES = {401, 403, 404, 410}
+LOG_BUFFER_CAPACITY = 32
+LOG_FLUSH_INTERVAL = 0.5
 
 logger = logging.getLogger("flatex-pdf-downloader")
 
 
 class FlatexError(RuntimeError):
-    pass
+    def __init__(self, message: str, status: int | None = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retriable(self) -> bool:
+        # 0 means the in-page fetch or the evaluate itself failed before any response.
+        return self.status == 0 or self.status in RETRIABLE_STATUSES
 
 
 def parse_args() -> argparse.Namespace:
@@ -32,6 +58,14 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--profile-dir", default=".playwright-profile", help="Persistent Chromium profile")
     parser.add_argument("--timeout", type=int, default=30, help="HTTP timeout in seconds")
     parser.add_argument("--retries", type=int, default=3, help="Retries per row")
+    parser.add_argument("--workers", type=int, default=8, help="Rows processed concurrently")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=5,
+        help="Maximum PDF requests in flight to Flatex at once",
+    )
+    parser.add_argument("--batch-size", type=int, default=32, help="Rows resolved per page round-trip")
     parser.add_argument("--start-row", type=int, default=1, help="1-based row index to start from")
     parser.add_argument("--end-row", type=int, default=0, help="1-based row index to end at (0 = all)")
     parser.add_argument("--skip-existing", action="store_true", help="Skip file if it already exists")
@@ -50,16 +84,28 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def configure_logging(level: str) -> None:
-    logging.basicConfig(level=getattr(logging, level), format="%(asctime)s %(levelname)s %(message)s")
+def configure_logging(level: str) -> logging.handlers.MemoryHandler:
+    # Per-row lines are buffered and written in bursts; errors still flush immediately and
+    # logging's atexit shutdown flushes whatever is left.
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    buffered = logging.handlers.MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.ERROR, target=stream)
+    logging.basicConfig(level=getattr(logging, level), handlers=[buffered])
+    return buffered
 
 
-def get_archive_state(page: Page) -> dict:
+async def flush_logs_periodically(handler: logging.Handler, interval: float = LOG_FLUSH_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        handler.flush()
+
+
+async def get_archive_state(page: Page) -> dict:
     now = datetime.now()
     default_start = f"01.01.{now.year - 5}"
     default_end = now.strftime("%d.%m.%Y")
 
-    state = page.evaluate(
+    state = await page.evaluate(
         """
         ({ rowSelector, defaultStart, defaultEnd }) => {
           const pick = (selector) => document.querySelector(selector);
@@ -88,6 +134,10 @@ def get_archive_state(page: Page) -> dict:
           return {
             pageUrl: location.href,
             rowCount: document.querySelectorAll(rowSelector).length,
+            rowTexts: Array.from(
+              document.querySelectorAll(rowSelector),
+              (row) => row.textContent.replace(/\\s+/g, ' ').trim(),
+            ),
             credentials: { tokenId, windowId },
             form: {
               'dateRangeComponent.startDate.text': value('#documentArchiveListForm_dateRangeComponent_startDate', defaultStart),
@@ -115,79 +165,87 @@ def wait_for_user_ready() -> None:
     input("Press ENTER to start batch download... ")
 
 
-def fetch_row_command(page: Page, token_id: str, window_id: str, form_data: dict[str, str], row_index: int) -> dict:
-    payload = page.evaluate(
-        """
-        async ({ tokenId, windowId, formData, rowIndex }) => {
-          const fd = new FormData();
-          for (const [k, v] of Object.entries(formData)) {
-            fd.set(k, String(v));
-          }
-          fd.set('documentArchiveListTable.selectedrowidx', String(rowIndex));
-
-          const res = await fetch('', {
-            method: 'POST',
-            headers: {
-              'x-ajax': 'true',
-              'x-requested-with': 'XMLHttpRequest',
-              'x-tokenid': tokenId,
-              'x-windowid': windowId,
-            },
-            body: fd,
-          });
-
-          const text = await res.text();
-          try {
-            return {
-              ok: res.ok,
-              status: res.status,
-              json: JSON.parse(text),
-              parseError: null,
-            };
-          } catch (error) {
-            return {
-              ok: res.ok,
-              status: res.status,
-              json: null,
-              parseError: String(error),
-              raw: text,
-            };
-          }
-        }
-        """,
+async def install_archive_context(page: Page, state: dict) -> None:
+    # Credentials and filter form are bound once per page so row fetches only ship indices.
+    await page.evaluate(
+        "(ctx) => { window.__flatex_ctx = ctx; }",
         {
-            "tokenId": token_id,
-            "windowId": window_id,
-            "formData": form_data,
-            "rowIndex": row_index,
+            "tokenId": state["credentials"]["tokenId"],
+            "windowId": state["credentials"]["windowId"],
+            "formData": state["form"],
+            "pageUrl": state["pageUrl"],
+            "linkPattern": PDF_LINK_PATTERN,
         },
     )
-    return payload
 
 
-def get_row_pdf_link(page: Page, state: dict, row_index: int) -> str:
-    creds = state["credentials"]
-    payload = fetch_row_command(page, creds["tokenId"], creds["windowId"], state["form"], row_index)
+async def fetch_row_commands_batch(
+    page: Page,
+    row_indices: list[int],
+    parallelism: int = ROW_FETCH_PARALLELISM,
+) -> list[dict] | None:
+    # The command JSON is parsed in the page and only the PDF URL crosses back to Python.
+    payloads = await page.evaluate(
+        "({ rowIndices, parallelism }) => window.__flatex_fetchRows(rowIndices, parallelism)",
+        {"rowIndices": row_indices, "parallelism": parallelism},
+    )
+    return payloads
+
+
+ROW_COMMAND_ERRORS = {
+    "parse": "command parse failed",
+    "commands-missing": "command list missing",
+    "execute-missing": "execute command missing",
+    "no-match": "command-invalid: no PDF link pattern matched",
+}
 
-    if not payload.get("ok"):
-        raise FlatexError(f"row {row_index}: command HTTP {payload.get('status')}")
 
-    data = payload.get("json")
-    if not isinstance(data, dict):
-        raise FlatexError(f"row {row_index}: command parse failed")
+def pdf_link_from_payload(payload: dict, row_index: int) -> str:
+    if payload.get("ok"):
+        return payload["url"]
 
-    commands = data.get("commands")
-    if not isinstance(commands, list):
-        raise FlatexError(f"row {row_index}: command list missing")
+    err = payload.get("err")
+    if err in ROW_COMMAND_ERRORS:
+        raise FlatexError(f"row {row_index}: {ROW_COMMAND_ERRORS[err]}")
+    raise FlatexError(f"row {row_index}: command HTTP {payload.get('status')}", status=payload.get("status"))
 
-    execute = next((cmd for cmd in commands if isinstance(cmd, dict) and cmd.get("command") == "execute"), None)
-    if not isinstance(execute, dict) or not isinstance(execute.get("script"), str):
-        raise FlatexError(f"row {row_index}: execute command missing")
 
+async def get_row_pdf_links(page: Page, state: dict, row_indices: list[int]) -> dict[int, str | FlatexError]:
     try:
-        return extract_pdf_link_from_script(execute["script"], state["pageUrl"])
-    except RuntimeError as exc:
-        raise FlatexError(str(exc)) from exc
+        payloads = await fetch_row_commands_batch(page, row_indices)
+        if payloads is None:
+            # A navigation dropped the bound context; rebind and try once more.
+            await install_archive_context(page, state)
+            payloads = await fetch_row_commands_batch(page, row_indices)
+        if payloads is None:
+            raise FlatexError("archive context missing on page")
+    except Exception as exc:
+        return {row_index: FlatexError(f"row {row_index}: {exc}", status=0) for row_index in row_indices}
+
+    links: dict[int, str | FlatexError] = {}
+    for payload in payloads:
+        row_index = payload["rowIndex"]
+        try:
+            links[row_index] = pdf_link_from_payload(payload, row_index)
+        except FlatexError as exc:
+            links[row_index] = exc
+    return links
+
+
+async def get_row_pdf_link(page: Page, state: dict, row_index: int) -> str:
+    link = (await get_row_pdf_links(page, state, [row_index]))[row_index]
+    if isinstance(link, FlatexError):
+        raise link
+    return link
+
+
+def order_by_host(links: dict[int, str | FlatexError]) -> list[tuple[int, str | FlatexError]]:
+    # Consecutive downloads from the same host reuse its keep-alive connection; the sort is
+    # stable, so row order is kept within a host and failed resolutions go first.
+    return sorted(
+        links.items(),
+        key=lambda item: urlparse(item[1]).netloc if isinstance(item[1], str) else "",
+    )
 
 
 def write_report(output_dir: Path, report_file: str, report: dict) -> None:
@@ -196,9 +254,116 @@ def write_report(output_dir: Path, report_file: str, report: dict) -> None:
     logger.info("Report written: %s", path)
 
 
-def main() -> int:
+async def run_task_group(*coros: Awaitable[None]) -> None:
+    # asyncio.TaskGroup semantics for Python 3.10: the first failure (or cancellation of the
+    # caller) cancels every sibling instead of leaving workers blocked on the queue.
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+def _backoff(attempt: int, base: float = 1.0, cap: float = 10.0) -> float:
+    return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+async def process_row(
+    client: httpx.AsyncClient,
+    page: Page,
+    state: dict,
+    row_index: int,
+    end_row: int,
+    args: argparse.Namespace,
+    output_dir: Path,
+    existing_names: set[str],
+    resolved: str | Exception | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+    breaker: CircuitBreaker | None = None,
+    manifest: ResumeLog | None = None,
+) -> tuple[str, str, str | None, str | None]:
+    row_no = row_index + 1
+    link = ""
+    error = ""
+    row_ok = False
+    row_msg = ""
+    row_name = None
+    last_link = ""
+    stem = optimistic_name = ""
+
+    for attempt in range(1, args.retries + 1):
+        # The first attempt uses the batch-resolved link. Later attempts keep it unless the
+        # server said it expired; a 5xx or dropped connection does not invalidate the link.
+        if not link:
+            pending, resolved = resolved, None
+            try:
+                if isinstance(pending, Exception):
+                    raise pending
+                link = pending or await get_row_pdf_link(page, state, row_index)
+            except Exception as exc:
+                error = str(exc)
+                logger.warning("[%s/%s] link resolve failed attempt %s: %s", row_no, end_row, attempt, error)
+                # Parse/shape errors will not recover by waiting; only back off on server-side trouble.
+                retriable = not isinstance(exc, FlatexError) or exc.retriable
+                if retriable and attempt < args.retries:
+                    await asyncio.sleep(_backoff(attempt))
+                continue
+            stem = build_stable_stem(link)
+            optimistic_name = filename_from_url(link, stem)
+
+        last_link = link
+        result = await save_pdf_from_link(
+            client,
+            page,
+            link,
+            output_dir,
+            args.timeout,
+            args.skip_existing,
+            existing_names,
+            stem=stem,
+            optimistic_name=optimistic_name,
+            semaphore=semaphore,
+            attempts=args.retries,
+            breaker=breaker,
+            manifest=manifest,
+        )
+        row_msg = result.message
+        if result.ok:
+            row_ok = True
+            row_name = result.name
+            break
+
+        logger.warning("[%s/%s] attempt %s failed: %s", row_no, end_row, attempt, row_msg)
+        if result.status in EXPIRED_LINK_STATUSES:
+            link = ""
+            continue
+        if result.retriable and attempt < args.retries:
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        break
+
+    if not last_link:
+        reason = f"could not resolve PDF link ({error})"
+        logger.error("[%s/%s] FAIL: %s", row_no, end_row, reason)
+        return "failed", reason, None, None
+
+    if row_ok:
+        logger.info("[%s/%s] OK: %s", row_no, end_row, row_msg)
+        return ("skipped" if row_msg.startswith("skipped existing") else "downloaded"), row_msg, None, row_name
+
+    logger.error("[%s/%s] FAIL: %s :: %s", row_no, end_row, row_msg, last_link)
+    return "failed", row_msg, last_link, None
+
+
+async def main() -> int:
     args = parse_args()
-    configure_logging(args.log_level)
+    log_handler = configure_logging(args.log_level)
+    log_flusher = asyncio.create_task(flush_logs_periodically(log_handler))
 
     output_dir = Path(args.output_dir)
     profile_dir = Path(args.profile_dir)
@@ -207,107 +372,132 @@ def main() -> int:
 
     failures: list[dict[str, object]] = []
 
-    with sync_playwright() as p:
-        context = p.chromium.launch_persistent_context(
+    async with async_playwright() as p:
+        context = await p.chromium.launch_persistent_context(
             user_data_dir=str(profile_dir),
             headless=args.headless,
             accept_downloads=True,
             viewport={"width": 1400, "height": 1000},
         )
 
-        page = context.new_page()
+        page = await context.new_page()
         logger.info("Opening: %s", args.archive_url)
-        page.goto(args.archive_url, wait_until="domcontentloaded")
+        await page.goto(args.archive_url, wait_until="domcontentloaded")
 
+        log_handler.flush()
         wait_for_user_ready()
-        time.sleep(1)
+        await asyncio.sleep(1)
 
-        state = get_archive_state(page)
+        state = await get_archive_state(page)
         row_count = int(state.get("rowCount", 0))
         token_id = state.get("credentials", {}).get("tokenId", "")
         window_id = state.get("credentials", {}).get("windowId", "")
 
         if row_count <= 0:
             logger.error("No rows found. Confirm you are on Flatex document archive (classic view).")
-            context.close()
+            await context.close()
             return 1
 
         if not token_id or not window_id:
             logger.error("Could not extract Flatex token/window credentials from page context.")
-            context.close()
+            await context.close()
             return 1
 
         start_row = max(1, args.start_row)
         end_row = row_count if args.end_row <= 0 else min(args.end_row, row_count)
         if start_row > end_row:
             logger.error("Invalid range: start-row (%s) > end-row (%s)", start_row, end_row)
-            context.close()
+            await context.close()
             return 1
 
-        logger.info("Found %s rows. Processing rows %s..%s", row_count, start_row, end_row)
-
-        success = 0
-        failed = 0
-        skipped = 0
         total = end_row - start_row + 1
+        workers = max(1, min(args.workers, total))
+        user_agent = await page.evaluate("() => navigator.userAgent")
+        max_concurrency = max(1, args.max_concurrency)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        breaker = CircuitBreaker()
+        client = await build_http_client(context, user_agent, max_concurrency)
+        prewarm = asyncio.create_task(prewarm_connection(client, args.archive_url))
+        await install_page_helpers(page)
+        await install_archive_context(page, state)
+        logger.info(
+            "Found %s rows. Processing rows %s..%s with %s workers, at most %s requests in flight",
+            row_count,
+            start_row,
+            end_row,
+            workers,
+            max_concurrency,
+        )
 
-        for row_index in range(start_row - 1, end_row):
-            row_no = row_index + 1
-            link = ""
-            error = ""
-            row_ok = False
-            row_msg = ""
-            last_link = ""
-
-            for attempt in range(1, args.retries + 1):
-                try:
-                    link = get_row_pdf_link(page, state, row_index)
-                except Exception as exc:
-                    error = str(exc)
-                    logger.warning("[%s/%s] link resolve failed attempt %s: %s", row_no, end_row, attempt, error)
-                    if attempt < args.retries:
-                        time.sleep(2)
+        # All workers share the archive page: Flatex binds tokenId/windowId to
+        # this window, and concurrent evaluates still overlap their fetches.
+        batch_size = max(1, args.batch_size)
+        swept = sweep_partial_files(output_dir)
+        if swept:
+            logger.info("Removed %s stale partial download(s) from an earlier run", swept)
+        existing_names = list_output_names(output_dir)
+        resume_log = ResumeLog(output_dir / RESUME_LOG_NAME)
+        keys = row_keys(state.get("rowTexts", []))
+        queue: asyncio.Queue[tuple[int, str | Exception] | None] = asyncio.Queue(maxsize=2 * batch_size)
+        outcomes = {"downloaded": 0, "skipped": 0, "failed": 0}
+
+        async def producer() -> None:
+            for chunk_start in range(start_row - 1, end_row, batch_size):
+                row_indices = []
+                for row_index in range(chunk_start, min(chunk_start + batch_size, end_row)):
+                    # Rows finished in an earlier run skip link resolution entirely.
+                    key = keys[row_index] if row_index < len(keys) else None
+                    name = resume_log.name_for(key) if args.skip_existing and key else None
+                    if name and name in existing_names:
+                        outcomes["skipped"] += 1
+                        logger.info("[%s/%s] OK: skipped existing %s (resume log)", row_index + 1, end_row, name)
+                    else:
+                        row_indices.append(row_index)
+                if not row_indices:
                     continue
-
-                last_link = link
-                ok, msg, retriable = save_pdf_from_link(
-                    context,
+                links = await get_row_pdf_links(page, state, row_indices)
+                for item in order_by_host(links):
+                    await queue.put(item)
+            # On failure the task group cancels the workers, so sentinels are only needed here.
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def worker() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                row_index, resolved = item
+                outcome, msg, url, name = await process_row(
+                    client,
                     page,
-                    link,
+                    state,
+                    row_index,
+                    end_row,
+                    args,
                     output_dir,
-                    args.timeout,
-                    args.skip_existing,
+                    existing_names,
+                    resolved,
+                    semaphore,
+                    breaker,
+                    resume_log,
                 )
-                if ok:
-                    row_ok = True
-                    row_msg = msg
-                    break
-
-                row_msg = msg
-                logger.warning("[%s/%s] attempt %s failed: %s", row_no, end_row, attempt, msg)
-                if retriable and attempt < args.retries:
-                    time.sleep(2 * attempt)
-                    continue
-                break
-
-            if not link:
-                failed += 1
-                reason = f"could not resolve PDF link ({error})"
-                logger.error("[%s/%s] FAIL: %s", row_no, end_row, reason)
-                failures.append({"row": row_no, "reason": reason, "url": None})
-                continue
-
-            if row_ok:
-                if row_msg.startswith("skipped existing"):
-                    skipped += 1
-                else:
-                    success += 1
-                logger.info("[%s/%s] OK: %s", row_no, end_row, row_msg)
-            else:
-                failed += 1
-                url = last_link or link
-                logger.error("[%s/%s] FAIL: %s :: %s", row_no, end_row, row_msg, url)
-                failures.append({"row": row_no, "reason": row_msg, "url": url})
+                outcomes[outcome] += 1
+                if outcome == "failed":
+                    failures.append({"row": row_index + 1, "reason": msg, "url": url})
+                elif name and row_index < len(keys) and keys[row_index]:
+                    resume_log.record(keys[row_index], name)
+
+        try:
+            await run_task_group(producer(), *(worker() for _ in range(workers)))
+        finally:
+            prewarm.cancel()
+            await client.aclose()
+
+        success = outcomes["downloaded"]
+        skipped = outcomes["skipped"]
+        failed = outcomes["failed"]
+        failures.sort(key=lambda item: item["row"])
 
         logger.info(
             "Done. Downloaded: %s, skipped: %s, failed: %s, processed: %s, output: %s",
@@ -317,7 +507,7 @@ def main() -> int:
             total,
             output_dir.resolve(),
         )
-        context.close()
+        await context.close()
 
     report = {
         "total": total,
@@ -329,9 +519,10 @@ def main() -> int:
         "failures": failures,
     }
     write_report(output_dir, args.report_file, report)
+    log_flusher.cancel()
 
     return 0 if failed == 0 else 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(asyncio.run(main()))
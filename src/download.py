@@ -1,101 +1,459 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import errno
+import os
+import random
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from typing import NamedTuple
+from urllib.parse import urlparse
 
-from playwright.sync_api import BrowserContext, Page, Response
+import httpx
+from playwright.async_api import BrowserContext, Page
 
 from src.parse_utils import (
+    ALLOWED_DOWNLOAD_HOSTS,
+    STEM_QUERY_KEYS,
     build_stable_stem,
     filename_from_headers_or_url,
     filename_from_url,
     is_allowed_download_url,
+    legacy_stable_stem,
+    parse_url,
+    sanitize_filename,
 )
+from src.resume import ResumeLog
 
+PDF_CHUNK_SIZE = 1 << 16
+PDF_MAGIC_PROBE = 8
+PART_SUFFIX = ".part"
+PART_STALE_AFTER = 3600.0
+NO_HARD_LINK_ERRNOS = frozenset(
+    getattr(errno, name) for name in ("EPERM", "ENOTSUP", "EOPNOTSUPP", "EMLINK", "EXDEV") if hasattr(errno, name)
+)
+PART_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+RETRIABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_AFTER = 120.0
+
+
+class SaveResult(NamedTuple):
+    ok: bool
+    message: str
+    retriable: bool
+    name: str | None = None
+    status: int | None = None
+    retry_after: float | None = None
+
+
+@dataclass
+class CircuitBreaker:
+    # Per-host: after `threshold` consecutive 5xx/transport failures, calls are refused
+    # for `cooldown_s`; then a single probe is let through (half-open) and its outcome
+    # either closes the circuit or restarts the cooldown.
+    threshold: int = 5
+    cooldown_s: float = 30.0
+    failures: dict[str, int] = field(default_factory=dict)
+    opened_at: dict[str, float] = field(default_factory=dict)
+
+    def allow(self, host: str) -> bool:
+        opened = self.opened_at.get(host)
+        if opened is None:
+            return True
+        now = time.monotonic()
+        if now - opened < self.cooldown_s:
+            return False
+        # Restarting the clock makes this caller the only probe until the next cooldown.
+        self.opened_at[host] = now
+        return True
+
+    def record_success(self, host: str) -> None:
+        self.failures.pop(host, None)
+        self.opened_at.pop(host, None)
+
+    def record_failure(self, host: str) -> None:
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            self.opened_at[host] = time.monotonic()
 
-def warmup_pdf_link(page: Page, link: str) -> None:
-    page.evaluate(
-        """
-        async (url) => {
-          const frame = document.createElement('iframe');
-          frame.style.visibility = 'hidden';
-          frame.style.opacity = '0';
-          frame.style.width = '0';
-          frame.style.height = '0';
-
-          await new Promise((resolve, reject) => {
-            const t = window.setTimeout(() => reject(new Error('iframe-timeout')), 30000);
-            frame.addEventListener('load', () => {
-              window.clearTimeout(t);
-              resolve(null);
-            }, { once: true });
-            frame.src = url;
-            document.body.appendChild(frame);
-          });
-
-          await new Promise((resolve) => setTimeout(resolve, 5000));
-          frame.remove();
-        }
-        """,
-        link,
+    def record(self, host: str, result: SaveResult) -> None:
+        if (result.status is not None and result.status >= 500) or (result.status is None and result.retriable):
+            self.record_failure(host)
+        else:
+            self.record_success(host)
+
+
+async def warmup_pdf_link(page: Page, link: str) -> None:
+    await page.evaluate("(url) => window.__flatex_warmup(url)", link)
+
+
+async def sync_cookies(client: httpx.AsyncClient, context: BrowserContext) -> None:
+    cookies = await context.cookies([f"https://{host}/" for host in sorted(ALLOWED_DOWNLOAD_HOSTS)])
+    for cookie in cookies:
+        client.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+
+
+async def build_http_client(context: BrowserContext, user_agent: str, pool_size: int) -> httpx.AsyncClient:
+    # One keep-alive pool for every PDF GET; bytes no longer cross the Playwright bridge.
+    # HTTP/2 multiplexes concurrent downloads over a single TLS connection when Flatex offers it.
+    client = httpx.AsyncClient(
+        headers={"user-agent": user_agent},
+        follow_redirects=True,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=60,
+        ),
     )
+    await sync_cookies(client, context)
+    return client
+
+
+async def prewarm_connection(client: httpx.AsyncClient, url: str) -> None:
+    # Opens a pooled connection (TCP + TLS) to the download host while the first batch of
+    # links is still resolving; the first PDF GET then reuses it.
+    host = urlparse(url).hostname or ""
+    if host.lower() not in ALLOWED_DOWNLOAD_HOSTS:
+        return
+    try:
+        await client.head(f"https://{host}/", timeout=10)
+    except httpx.HTTPError:
+        pass
 
 
-def fetch_pdf_response(context: BrowserContext, link: str, timeout_s: int) -> Response:
-    return context.request.get(link, timeout=timeout_s * 1000)
+async def fetch_pdf_response(client: httpx.AsyncClient, link: str, timeout_s: int) -> httpx.Response:
+    # Streamed: the caller reads the body in chunks and must close the response.
+    request = client.build_request("GET", link, timeout=timeout_s)
+    return await client.send(request, stream=True)
 
 
-def save_pdf_from_link(
-    context: BrowserContext,
+async def save_pdf_from_link(
+    client: httpx.AsyncClient,
     page: Page,
     link: str,
     output_dir: Path,
     timeout_s: int,
     skip_existing: bool,
-) -> tuple[bool, str, bool]:
-    if not is_allowed_download_url(link):
-        return False, "blocked non-Flatex download host", False
+    existing_names: set[str],
+    stem: str | None = None,
+    optimistic_name: str | None = None,
+    semaphore: asyncio.Semaphore | None = None,
+    attempts: int = 3,
+    breaker: CircuitBreaker | None = None,
+    manifest: ResumeLog | None = None,
+) -> SaveResult:
+    # Parsed once here; every helper below reads the same UrlInfo.
+    info = parse_url(link)
+    if not is_allowed_download_url(info):
+        return SaveResult(False, "blocked non-Flatex download host", False)
 
-    stem = build_stable_stem(link)
+    # Callers retrying the same link pass these in so each retry is only network work.
+    stem = stem or build_stable_stem(info)
     if skip_existing:
-        optimistic_name = filename_from_url(link, stem)
-        optimistic_target = output_dir / optimistic_name
-        if optimistic_target.exists():
-            return True, f"skipped existing {optimistic_target.name}", False
+        optimistic_name = optimistic_name or filename_from_url(info, stem)
+        if optimistic_name in existing_names:
+            return SaveResult(True, f"skipped existing {optimistic_name}", False, optimistic_name)
+        # Only hash-named files can carry the old SHA-1 stem; other names never used it.
+        if info.first(STEM_QUERY_KEYS) is None and optimistic_name == sanitize_filename(f"{stem}.pdf"):
+            legacy_name = sanitize_filename(f"{legacy_stable_stem(info)}.pdf")
+            if legacy_name in existing_names:
+                return SaveResult(True, f"skipped existing {legacy_name}", False, legacy_name)
+        known_name = manifest.name_for_link(link) if manifest is not None else None
+        if known_name in existing_names:
+            return SaveResult(True, f"skipped existing {known_name} (manifest)", False, known_name)
+
+    host = info.host
+    result = SaveResult(False, "no download attempt made", False)
+    warmed = False
+    probing = False
+    for attempt in range(max(1, attempts)):
+        if attempt:
+            # Sleeping outside the semaphore keeps waiting workers from holding network slots.
+            delay = backoff_delay(attempt)
+            if result.retry_after is not None:
+                delay = max(min(result.retry_after, MAX_RETRY_AFTER), delay)
+            await asyncio.sleep(delay)
+        if result.status == 503:
+            # Outside the semaphore: warm-ups queue one at a time in the page and can take
+            # up to 30 s each, which must not pin network slots other workers could use.
+            try:
+                await warmup_pdf_link(page, link)
+                warmed = True
+            except Exception as exc:
+                result = SaveResult(False, f"503 warm-up failed: {exc}", True, status=503)
+                if breaker is not None:
+                    breaker.record_failure(host)
+                continue
+        # The semaphore bounds in-flight requests to Flatex across all workers.
+        async with semaphore or contextlib.nullcontext():
+            # A half-open probe keeps its admission until its own warm-up and refetch are done.
+            if breaker is not None and not probing:
+                if not breaker.allow(host):
+                    return SaveResult(False, "circuit open", True)
+                probing = host in breaker.opened_at
+            result = await _download_pdf(
+                client, page, link, output_dir, timeout_s, stem, skip_existing, existing_names, manifest
+            )
+        # A first 503 is Flatex's normal "cold PDF" answer; it only counts against the host
+        # once a warm-up for this link has also failed to help.
+        if breaker is not None and (result.status != 503 or warmed):
+            breaker.record(host, result)
+        if result.ok or not result.retriable:
+            return result
+    # The retry budget is spent here; callers must not retry the same link again.
+    return result._replace(retriable=False)
+
 
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    # Full jitter: concurrent workers hitting the same 503 spread their retries out.
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def _retry_after_seconds(response: httpx.Response) -> float | None:
+    # RFC 7231 allows either delta-seconds or an HTTP-date.
+    value = (response.headers.get("retry-after") or "").strip()
+    if not value:
+        return None
+    # isdigit() alone accepts digits like "²" that float() rejects.
+    if value.isascii() and value.isdigit():
+        return float(value)
     try:
-        response = fetch_pdf_response(context, link, timeout_s)
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+async def _download_pdf(
+    client: httpx.AsyncClient,
+    page: Page,
+    link: str,
+    output_dir: Path,
+    timeout_s: int,
+    stem: str,
+    skip_existing: bool,
+    existing_names: set[str],
+    manifest: ResumeLog | None = None,
+) -> SaveResult:
+    try:
+        response = await fetch_pdf_response(client, link, timeout_s)
+        if response.status_code in (401, 403):
+            # Browser session may have refreshed its cookies since the last sync.
+            await response.aclose()
+            await sync_cookies(client, page.context)
+            response = await fetch_pdf_response(client, link, timeout_s)
     except Exception as exc:
-        return False, f"request failed: {exc}", True
+        return SaveResult(False, f"request failed: {exc}", True)
 
-    if response.status == 503:
-        try:
-            warmup_pdf_link(page, link)
-            response = fetch_pdf_response(context, link, timeout_s)
-        except Exception as exc:
-            return False, f"503 warm-up failed: {exc}", True
+    try:
+        return await write_pdf_response(response, link, output_dir, stem, skip_existing, existing_names, manifest)
+    finally:
+        await response.aclose()
 
-    if not response.ok:
-        return False, f"HTTP {response.status}", response.status in (429, 500, 502, 503, 504)
 
-    body = response.body()
-    ctype = response.headers.get("content-type", "").lower()
-    if "pdf" not in ctype and not body.startswith(b"%PDF"):
-        return False, f"not a PDF (content-type={ctype or 'unknown'})", False
+def sweep_partial_files(output_dir: Path, max_age: float = PART_STALE_AFTER) -> int:
+    # Leftovers from a crashed run; they never carry a final name, so dropping them is safe.
+    # A .part written within `max_age` may belong to another live run on the same output
+    # dir (the O_EXCL create steps around those), so it is left alone.
+    count = 0
+    cutoff = time.time() - max_age
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(PART_SUFFIX):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    count += 1
+    return count
+
+
+def list_output_names(output_dir: Path) -> set[str]:
+    # One directory listing up front; name checks and collision probes are set lookups
+    # from here on. scandir avoids a stat() per entry.
+    with os.scandir(output_dir) as entries:
+        return {entry.name for entry in entries}
+
+
+async def _read_prefix(chunks: AsyncIterator[bytes], size: int) -> bytes:
+    prefix = b""
+    async for chunk in chunks:
+        prefix += chunk
+        if len(prefix) >= size:
+            break
+    return prefix
+
+
+def _next_free_name(name: str, existing_names: set[str]) -> str:
+    # Suffixes are handed out in order, so taken ones form a run from _2 upwards: probe
+    # 2, 4, 8, ... to a free slot, then binary-search the boundary. Any free slot is
+    # acceptable if a gap was left behind by a deleted file.
+    base, suffix = Path(name).stem, Path(name).suffix
+
+    def taken(i: int) -> bool:
+        return f"{base}_{i}{suffix}" in existing_names
+
+    lo, hi = 1, 2
+    while taken(hi):
+        lo, hi = hi, hi * 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if taken(mid):
+            lo = mid
+        else:
+            hi = mid
+    return f"{base}_{hi}{suffix}"
+
+
+async def write_pdf_response(
+    response: httpx.Response,
+    link: str,
+    output_dir: Path,
+    stem: str,
+    skip_existing: bool,
+    existing_names: set[str],
+    manifest: ResumeLog | None = None,
+) -> SaveResult:
+    if not response.is_success:
+        status = response.status_code
+        return SaveResult(
+            False,
+            f"HTTP {status}",
+            status in RETRIABLE_STATUSES,
+            status=status,
+            retry_after=_retry_after_seconds(response),
+        )
 
     name = filename_from_headers_or_url(response, link, stem)
+    etag = response.headers.get("etag")
+    last_modified = response.headers.get("last-modified")
+    if skip_existing:
+        # With a manifest, the document (its stable stem) decides, not the filename: its own
+        # recorded copy must still exist and its own validators must be unchanged.
+        known = manifest.name_for_doc(stem) if manifest is not None else None
+        if known is not None and known in existing_names:
+            if not manifest.replaced(stem, name, etag, last_modified):
+                return SaveResult(True, f"skipped existing {known}", False, known)
+        elif known is None and name in existing_names:
+            if manifest is None or not manifest.replaced(stem, name, etag, last_modified):
+                return SaveResult(True, f"skipped existing {name}", False, name)
+
+    # Peek only the first bytes: an HTML error page (e.g. on session expiry) is rejected
+    # before any more of it is transferred or anything touches the disk.
+    chunks = response.aiter_bytes()
+    try:
+        head = await _read_prefix(chunks, PDF_MAGIC_PROBE)
+    except httpx.HTTPError as exc:
+        return SaveResult(False, f"request failed: {exc}", True)
+
+    ctype = response.headers.get("content-type", "").lower()
+    if "pdf" not in ctype and not head.startswith(b"%PDF"):
+        return SaveResult(False, f"not a PDF (content-type={ctype or 'unknown'})", False)
+
+    source_name = name
+    if name in existing_names:
+        name = _next_free_name(name, existing_names)
+
+    # Reserve the name up front so concurrent workers never pick the same target.
+    existing_names.add(name)
     target = output_dir / name
-    if skip_existing and target.exists():
-        return True, f"skipped existing {target.name}", False
 
-    if target.exists():
-        i = 2
-        while True:
-            alt = output_dir / f"{target.stem}_{i}{target.suffix}"
-            if not alt.exists():
-                target = alt
-                break
-            i += 1
+    # Stream into a sibling .part file so a partial body never shows up under the final name.
+    # Disk calls run in worker threads so other downloads keep the event loop.
+    size = 0
+    while True:
+        tmp = target.with_name(target.name + PART_SUFFIX)
+        try:
+            fd = await asyncio.to_thread(os.open, tmp, PART_OPEN_FLAGS, 0o644)
+            break
+        except FileExistsError:
+            # O_EXCL: never truncate a .part another process is still writing; move on.
+            name = _next_free_name(source_name, existing_names)
+            existing_names.add(name)
+            target = output_dir / name
+        except BaseException:
+            existing_names.discard(name)
+            raise
+    try:
+        pending: asyncio.Future[None] | None = None
+        try:
+            # Network chunks arrive in whatever sizes the server sends; coalesce writes.
+            # One write stays in flight while the next buffer fills, so socket and disk
+            # overlap and memory stays bounded at two chunks.
+            buffer = bytearray(head)
+            async for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= PDF_CHUNK_SIZE:
+                    if pending is not None:
+                        await pending
+                    pending = asyncio.ensure_future(asyncio.to_thread(_write_all, fd, buffer))
+                    size += len(buffer)
+                    buffer = bytearray()
+            if pending is not None:
+                await pending
+                pending = None
+            await asyncio.to_thread(_write_all, fd, buffer)
+            size += len(buffer)
+        finally:
+            if pending is not None:
+                # Never close the descriptor under a write that is still running.
+                with contextlib.suppress(Exception):
+                    await pending
+            await asyncio.to_thread(os.close, fd)
+    except httpx.HTTPError as exc:
+        existing_names.discard(name)
+        await asyncio.to_thread(tmp.unlink, missing_ok=True)
+        return SaveResult(False, f"download interrupted: {exc}", True)
+    except BaseException:
+        existing_names.discard(name)
+        tmp.unlink(missing_ok=True)
+        raise
+
+    while True:
+        try:
+            await asyncio.to_thread(_publish_no_clobber, tmp, target)
+            break
+        except FileExistsError:
+            # Something outside this run took the name after the startup listing; the name
+            # stays in the set because it now exists on disk.
+            name = _next_free_name(source_name, existing_names)
+            existing_names.add(name)
+            target = output_dir / name
+        except OSError as exc:
+            # Disk errors, or the .part vanished under us: fail this row, not the run.
+            existing_names.discard(name)
+            await asyncio.to_thread(tmp.unlink, missing_ok=True)
+            return SaveResult(False, f"could not publish {name}: {exc}", True)
+    if manifest is not None:
+        manifest.record_link(link, target.name, etag, last_modified, stem)
+    return SaveResult(True, f"saved {target.name} ({size / 1024:.1f} KB)", False, target.name)
 
-    target.write_bytes(body)
-    return True, f"saved {target.name} ({target.stat().st_size / 1024:.1f} KB)", False
 
+def _write_all(fd: int, data: bytearray) -> None:
+    # os.write may be partial; slicing a memoryview resumes without copying the buffer.
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _publish_no_clobber(tmp: Path, target: Path) -> None:
+    # link() fails with FileExistsError instead of silently replacing a file that
+    # appeared under the same name. Only filesystems that cannot hard-link fall back to
+    # rename; any other error (EACCES, ENOSPC, EIO, a vanished .part) propagates.
+    try:
+        os.link(tmp, target)
+    except OSError as exc:
+        if isinstance(exc, FileExistsError) or exc.errno not in NO_HARD_LINK_ERRNOS:
+            raise
+        os.replace(tmp, target)
+        return
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(tmp)
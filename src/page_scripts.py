@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+from playwright.async_api import Page
+
+# Installed once per page (and re-installed on navigations via add_init_script); hot-path
+# evaluates then only ship a function name and their arguments.
+FLATEX_JS = r"""
+window.__flatex_fetchRows = async (rowIndices, parallelism) => {
+  if (!window.__flatex_ctx) return null;
+  const { tokenId, windowId, formData, pageUrl, linkPattern } = window.__flatex_ctx;
+  const linkRe = new RegExp(linkPattern);
+
+  const post = async (rowIndex) => {
+    const fd = new FormData();
+    for (const [k, v] of Object.entries(formData)) {
+      fd.set(k, String(v));
+    }
+    fd.set('documentArchiveListTable.selectedrowidx', String(rowIndex));
+
+    const res = await fetch('', {
+      method: 'POST',
+      headers: {
+        'x-ajax': 'true',
+        'x-requested-with': 'XMLHttpRequest',
+        'x-tokenid': tokenId,
+        'x-windowid': windowId,
+      },
+      body: fd,
+    });
+    const fail = (err) => ({ rowIndex, ok: false, status: res.status, err });
+    if (!res.ok) return fail('http');
+
+    let data;
+    try {
+      data = JSON.parse(await res.text());
+    } catch (_) {
+      return fail('parse');
+    }
+    if (!data || typeof data !== 'object') return fail('parse');
+    if (!Array.isArray(data.commands)) return fail('commands-missing');
+
+    const execute = data.commands.find((cmd) => cmd && cmd.command === 'execute');
+    if (!execute || typeof execute.script !== 'string') return fail('execute-missing');
+
+    const m = execute.script.match(linkRe);
+    if (!m) return fail('no-match');
+    const raw = m[1].replace(/\\\//g, '/').replace(/\\u0026/g, '&');
+    return { rowIndex, ok: true, url: new URL(raw, pageUrl).toString() };
+  };
+
+  // Small p-limit style gate: `parallelism` lanes pull the next index.
+  const results = new Array(rowIndices.length);
+  let next = 0;
+  const lane = async () => {
+    while (next < rowIndices.length) {
+      const slot = next++;
+      try {
+        results[slot] = await post(rowIndices[slot]);
+      } catch (_) {
+        results[slot] = { rowIndex: rowIndices[slot], ok: false, status: 0, err: 'http' };
+      }
+    }
+  };
+  await Promise.all(Array.from({ length: Math.min(parallelism, rowIndices.length) }, lane));
+  return results;
+};
+
+window.__flatex_warmChain = Promise.resolve();
+
+// Warm-ups run one at a time through a single long-lived hidden iframe, so clustered
+// 503s queue here instead of each attaching and tearing down a frame of its own.
+window.__flatex_warmup = (url) => {
+  const run = window.__flatex_warmChain.then(() => window.__flatex_warmupOnce(url));
+  window.__flatex_warmChain = run.catch(() => {});
+  return run;
+};
+
+window.__flatex_warmupOnce = async (url) => {
+  let frame = window.__flatex_warmFrame;
+  if (!frame || !frame.isConnected) {
+    frame = document.createElement('iframe');
+    frame.style.visibility = 'hidden';
+    frame.style.opacity = '0';
+    frame.style.width = '0';
+    frame.style.height = '0';
+    document.body.appendChild(frame);
+    window.__flatex_warmFrame = frame;
+  }
+
+  let loadedAt = null;
+  const onLoad = () => {
+    loadedAt = Date.now();
+  };
+  frame.addEventListener('load', onLoad);
+
+  // Leave as soon as the PDF resource finished or a HEAD probe gets a 2xx, or at most
+  // 5 s after the iframe loaded. An observer (not getEntriesByName) ignores entries
+  // from earlier warm-ups of the same URL.
+  let resourceDone = false;
+  // Only the iframe's own entry counts: the HEAD probes below create 'fetch' entries for
+  // the same URL even when they are answered with a 503.
+  const observer = new PerformanceObserver((list) => {
+    const entries = list.getEntriesByName(url);
+    if (entries.some((e) => e.initiatorType === 'iframe' && e.responseEnd > 0)) resourceDone = true;
+  });
+  observer.observe({ type: 'resource' });
+  frame.src = url;
+
+  // Probe interval doubles from 100 ms up to 2 s. Only 503/429 mean "still preparing";
+  // any other answer shows HEAD carries no signal here, so probing stops.
+  let probe = true;
+  let delay = 100;
+  const deadline = Date.now() + 30000;
+  try {
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, delay));
+      if (resourceDone) return;
+      if (probe) {
+        try {
+          const res = await fetch(url, { method: 'HEAD', credentials: 'include', cache: 'no-store' });
+          if (res.ok) return;
+          if (res.status !== 503 && res.status !== 429) probe = false;
+        } catch (_) {
+          probe = false;
+        }
+      }
+      if (loadedAt !== null && Date.now() - loadedAt >= 5000) return;
+      if (Date.now() >= deadline) throw new Error('iframe-timeout');
+      delay = Math.min(delay * 2, 2000);
+    }
+  } finally {
+    observer.disconnect();
+    frame.removeEventListener('load', onLoad);
+    // Stop the PDF load but keep the frame attached for the next warm-up.
+    frame.src = 'about:blank';
+  }
+};
+"""
+
+
+# page.evaluate calls its expression's value when that is a function, and a bare script's
+# completion value is its last assignment (a helper). Wrapping it in an arrow makes the
+# call install the helpers and return undefined instead of running one of them.
+FLATEX_INSTALL_JS = f"() => {{\n{FLATEX_JS}\n}}"
+
+
+async def install_page_helpers(page: Page) -> None:
+    await page.add_init_script(FLATEX_JS)
+    await page.evaluate(FLATEX_INSTALL_JS)
@@ -1,27 +1,41 @@
 from __future__ import annotations
 
+import functools
 import hashlib
 import re
+from dataclasses import dataclass, field
 from pathlib import Path
-from urllib.parse import parse_qs, unquote, urljoin, urlparse
+from urllib.parse import unquote, unquote_plus, urljoin, urlparse
 
-from playwright.sync_api import Response
+import httpx
 
-SCRIPT_PATTERNS = [
-    re.compile(r'finished\("([^\"]+)",'),
-    re.compile(r'display\("([^\"]+)",'),
-]
+PDF_LINK_PATTERN = r'(?:finished|display)\("([^"]+)",'
+_PDF_LINK_RE = re.compile(PDF_LINK_PATTERN)
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_SANITIZE_ALLOWED = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789._-")
+_SANITIZE_TABLE = bytes(c if c in _SANITIZE_ALLOWED else 0 for c in range(256))
 FILENAME_RE = re.compile(r"filename\*?=(?:UTF-8''|\")?([^\";]+)", re.IGNORECASE)
 ALLOWED_DOWNLOAD_HOSTS = {"konto.flatex.at", "konto.flatex.de"}
+FILENAME_QUERY_KEYS = ("filename", "file", "name", "documentName", "id")
+STEM_QUERY_KEYS = ("id", "documentId", "docId", "mailingId", "uuid")
 
 
 def sanitize_filename(name: str) -> str:
-    safe = re.sub(r"[^A-Za-z0-9._-]+", "_", name.strip())
-    safe = safe.strip("._")
+    name = name.strip()
+    if name.isascii():
+        # Same result as the regex, in C: disallowed bytes become NUL and each NUL run
+        # becomes one "_". Edge runs are dropped, which strip("._") would do anyway.
+        parts = name.encode("ascii").translate(_SANITIZE_TABLE).split(b"\0")
+        safe = b"_".join(part for part in parts if part).decode("ascii").strip("._")
+    else:
+        safe = _SANITIZE_RE.sub("_", name).strip("._")
     if not safe:
         return "document.pdf"
 
-    stem, ext = Path(safe).stem, Path(safe).suffix
+    # `safe` has no separators and no leading/trailing dot, so this split matches
+    # Path(safe).stem/.suffix without building two Path objects.
+    dot = safe.rfind(".")
+    stem, ext = (safe[:dot], safe[dot:]) if dot > 0 else (safe, "")
     stem = stem.rstrip("._")
     if not stem:
         stem = "document"
@@ -30,64 +44,93 @@ def sanitize_filename(name: str) -> str:
     return f"{stem}{ext}"
 
 
-def filename_from_headers_or_url(response: Response, url: str, fallback_stem: str) -> str:
+def _has_pdf_ext(name: str) -> bool:
+    # Only the 4-char tail is lowered; long candidates are not copied.
+    return name[-4:].lower() == ".pdf"
+
+
+@dataclass(frozen=True)
+class UrlInfo:
+    raw: str
+    host: str
+    path_tail: str
+    # First non-empty, already unquoted value per query key. Everything is derived from
+    # `raw`, so it alone defines equality and the hash used by the lru caches below.
+    qs: dict[str, str] = field(compare=False)
+
+    def first(self, keys: tuple[str, ...]) -> str | None:
+        # `keys` is in priority order, matching the old "first key present wins" lookups.
+        for key in keys:
+            value = self.qs.get(key)
+            if value:
+                return value
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_url(url: str | UrlInfo) -> UrlInfo:
+    if isinstance(url, UrlInfo):
+        return url
+    parsed = urlparse(url)
+    qs: dict[str, str] = {}
+    for pair in parsed.query.split("&"):
+        key, _, value = pair.partition("=")
+        if value and key not in qs:
+            qs[key] = unquote_plus(value)
+    return UrlInfo(url, (parsed.hostname or "").lower(), Path(parsed.path).name, qs)
+
+
+def filename_from_headers_or_url(response: httpx.Response, url: str | UrlInfo, fallback_stem: str) -> str:
     content_disp = response.headers.get("content-disposition", "")
     match = FILENAME_RE.search(content_disp)
     if match:
         candidate = unquote(match.group(1)).strip()
         if candidate:
-            if not candidate.lower().endswith(".pdf"):
+            if not _has_pdf_ext(candidate):
                 candidate += ".pdf"
             return sanitize_filename(candidate)
 
-    parsed = urlparse(url)
-    qs = parse_qs(parsed.query)
-    for key in ("filename", "file", "name", "documentName", "id"):
-        if key in qs and qs[key]:
-            candidate = unquote(qs[key][0])
-            if not candidate.lower().endswith(".pdf"):
+    # The URL half is shared with the optimistic skip check, so it is usually a cache hit.
+    return filename_from_url(url, fallback_stem)
+
+
+@functools.lru_cache(maxsize=4096)
+def filename_from_url(url: str | UrlInfo, fallback_stem: str) -> str:
+    info = parse_url(url)
+    value = info.first(FILENAME_QUERY_KEYS)
+    if value:
+        candidate = unquote(value).strip()
+        if candidate:
+            if not _has_pdf_ext(candidate):
                 candidate += ".pdf"
             return sanitize_filename(candidate)
 
-    tail = Path(parsed.path).name
+    tail = info.path_tail
     if tail:
-        if not tail.lower().endswith(".pdf"):
+        if not _has_pdf_ext(tail):
             tail += ".pdf"
         return sanitize_filename(unquote(tail))
 
     return sanitize_filename(f"{fallback_stem}.pdf")
 
 
-def filename_from_url(url: str, fallback_stem: str) -> str:
-    parsed = urlparse(url)
-    qs = parse_qs(parsed.query)
-    for key in ("filename", "file", "name", "documentName", "id"):
-        if key in qs and qs[key]:
-            candidate = unquote(qs[key][0]).strip()
-            if candidate:
-                if not candidate.lower().endswith(".pdf"):
-                    candidate += ".pdf"
-                return sanitize_filename(candidate)
-
-    tail = Path(parsed.path).name
-    if tail:
-        if not tail.lower().endswith(".pdf"):
-            tail += ".pdf"
-        return sanitize_filename(unquote(tail))
-
-    return sanitize_filename(f"{fallback_stem}.pdf")
+@functools.lru_cache(maxsize=4096)
+def build_stable_stem(url: str | UrlInfo) -> str:
+    info = parse_url(url)
+    value = info.first(STEM_QUERY_KEYS)
+    if value:
+        value = sanitize_filename(value)
+        if _has_pdf_ext(value):
+            value = Path(value).stem
+        return f"flatex_{value}"
+    digest = hashlib.blake2b(info.raw.encode("utf-8"), digest_size=6).hexdigest()
+    return f"flatex_{digest}"
 
 
-def build_stable_stem(url: str) -> str:
-    parsed = urlparse(url)
-    qs = parse_qs(parsed.query)
-    for key in ("id", "documentId", "docId", "mailingId", "uuid"):
-        if key in qs and qs[key]:
-            value = sanitize_filename(qs[key][0])
-            if value.lower().endswith(".pdf"):
-                value = Path(value).stem
-            return f"flatex_{value}"
-    digest = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+@functools.lru_cache(maxsize=4096)
+def legacy_stable_stem(url: str | UrlInfo) -> str:
+    # Hash-named files from older runs used a SHA-1 prefix; only skip-existing still needs it.
+    digest = hashlib.sha1(parse_url(url).raw.encode("utf-8")).hexdigest()[:12]
     return f"flatex_{digest}"
 
 
@@ -97,13 +140,12 @@ def normalize_command_url(url: str, base_url: str) -> str:
 
 
 def extract_pdf_link_from_script(script: str, base_url: str) -> str:
-    for pattern in SCRIPT_PATTERNS:
-        match = pattern.search(script)
-        if match:
-            return normalize_command_url(match.group(1), base_url)
-    raise RuntimeError("command-invalid: no PDF link pattern matched")
+    match = _PDF_LINK_RE.search(script)
+    if not match:
+        raise RuntimeError("command-invalid: no PDF link pattern matched")
+    return normalize_command_url(match.group(1), base_url)
 
 
-def is_allowed_download_url(url: str) -> bool:
-    host = urlparse(url).hostname or ""
-    return host.lower() in ALLOWED_DOWNLOAD_HOSTS
+@functools.lru_cache(maxsize=4096)
+def is_allowed_download_url(url: str | UrlInfo) -> bool:
+    return parse_url(url).host in ALLOWED_DOWNLOAD_HOSTS
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import json
+from collections import Counter
+from pathlib import Path
+
+RESUME_LOG_NAME = ".flatex_done.jsonl"
+
+
+def row_keys(row_texts: list[str]) -> list[str | None]:
+    # Row indices shift as soon as a new document lands in the archive, so rows are keyed
+    # by their visible text. Repeated texts get no key: an occurrence counter would shift
+    # too when a same-text document is added above, and hand its key to the new row.
+    counts = Counter(row_texts)
+    return [text if counts[text] == 1 else None for text in row_texts]
+
+
+class ResumeLog:
+    # Two kinds of lines share the file: row-key entries ({"key", "name"}) written by the
+    # CLI, and link entries ({"link", "name", "doc", "etag", "last_modified"}) written on
+    # save. `doc` is the document's stable stem; validators are only ever compared within
+    # the same document, never across documents that share a server-side filename.
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.done: dict[str, str] = {}
+        self.links: dict[str, str] = {}
+        self.docs: dict[str, tuple[str, str | None, str | None]] = {}
+        self.owners: dict[str, str] = {}
+        if not path.exists():
+            return
+        for line in path.read_text(encoding="utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+                continue
+            if isinstance(entry.get("key"), str):
+                self.done[entry["key"]] = entry["name"]
+            elif isinstance(entry.get("link"), str):
+                self.links[entry["link"]] = entry["name"]
+                if isinstance(entry.get("doc"), str):
+                    self._remember(entry["doc"], entry["name"], entry.get("etag"), entry.get("last_modified"))
+
+    def name_for(self, key: str) -> str | None:
+        return self.done.get(key)
+
+    def name_for_link(self, link: str) -> str | None:
+        return self.links.get(link)
+
+    def name_for_doc(self, doc: str) -> str | None:
+        known = self.docs.get(doc)
+        return known[0] if known else None
+
+    def replaced(self, doc: str, name: str, etag: str | None, last_modified: str | None) -> bool:
+        # `name` exists on disk. It is only this document's copy if no other recorded
+        # document owns it; a known document counts as replaced only when one of its own
+        # validators changed. Missing validators never prove a change.
+        known = self.docs.get(doc)
+        if known is None:
+            owner = self.owners.get(name)
+            return owner is not None and owner != doc
+        _, old_etag, old_modified = known
+        return bool(
+            (etag and old_etag and etag != old_etag)
+            or (last_modified and old_modified and last_modified != old_modified)
+        )
+
+    def record(self, key: str, name: str) -> None:
+        if self.done.get(key) == name:
+            return
+        self.done[key] = name
+        self._append({"key": key, "name": name})
+
+    def record_link(self, link: str, name: str, etag: str | None, last_modified: str | None, doc: str) -> None:
+        if self.links.get(link) == name and self.docs.get(doc) == (name, etag, last_modified):
+            return
+        self.links[link] = name
+        self._remember(doc, name, etag, last_modified)
+        self._append({"link": link, "name": name, "doc": doc, "etag": etag, "last_modified": last_modified})
+
+    def _remember(self, doc: str, name: str, etag: str | None, last_modified: str | None) -> None:
+        self.docs[doc] = (name, etag, last_modified)
+        self.owners[name] = doc
+
+    def _append(self, entry: dict) -> None:
+        with self.path.open("a", encoding="utf-8") as fh:
+            fh.write(json.dumps(entry) + "\n")
@@ -1,26 +1,55 @@
 from __future__ import annotations
 
+import asyncio
+import errno
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 from pathlib import Path
 
 import pytest
 
 import flatex_pdf_downloader as cli
 import src.download as dl
+import src.page_scripts as ps
 import src.parse_utils as pu
+import src.resume as rs
 
 
 class FakeResponse:
-    def __init__(self, *, status: int = 200, headers: dict[str, str] | None = None, body: bytes = b"%PDF-1.7"):
-        self.status = status
+    def __init__(
+        self,
+        *,
+        status: int = 200,
+        headers: dict[str, str] | None = None,
+        body: bytes = b"%PDF-1.7",
+        chunk_size: int | None = None,
+    ):
+        self.status_code = status
         self.headers = headers or {"content-type": "application/pdf"}
         self._body = body
+        self._chunk_size = chunk_size
+        self.chunks_read = 0
+        self.closed = False
 
     @property
-    def ok(self) -> bool:
-        return 200 <= self.status < 300
+    def is_success(self) -> bool:
+        return 200 <= self.status_code < 300
 
-    def body(self) -> bytes:
-        return self._body
+    async def aiter_bytes(self, chunk_size: int | None = None):
+        size = chunk_size or self._chunk_size or len(self._body) or 1
+        for start in range(0, len(self._body), size):
+            self.chunks_read += 1
+            yield self._body[start : start + size]
+
+    async def aclose(self) -> None:
+        self.closed = True
 
 
 class Dummy:
@@ -39,6 +68,12 @@ def test_extract_pdf_link_display_pattern_with_escaped_ampersand():
     assert link == "https://konto.flatex.at/downloadData/123/file.pdf?x=1&y=2"
 
 
+def test_extract_pdf_link_takes_earliest_call_in_one_scan():
+    script = 'display("/downloadData/1/first.pdf", "x"); finished("/downloadData/2/second.pdf", "y")'
+    link = pu.extract_pdf_link_from_script(script, "https://konto.flatex.at/archive")
+    assert link == "https://konto.flatex.at/downloadData/1/first.pdf"
+
+
 def test_extract_pdf_link_invalid_raises():
     with pytest.raises(RuntimeError):
         pu.extract_pdf_link_from_script("nope", "https://konto.flatex.at/")
@@ -49,22 +84,100 @@ def test_filename_from_url_and_sanitize():
     assert pu.filename_from_url(url, "fallback") == "My_File_1.pdf"
 
 
+def test_sanitize_filename_ascii_fast_path_matches_regex():
+    def reference(name: str) -> str:
+        safe = re.sub(r"[^A-Za-z0-9._-]+", "_", name.strip()).strip("._")
+        if not safe:
+            return "document.pdf"
+        stem = Path(safe).stem.rstrip("._") or "document"
+        return f"{stem}{Path(safe).suffix or '.pdf'}"
+
+    rng = random.Random(7)
+    alphabet = "aZ09._- /\\:\t_%+()\x00é"
+    names = ["", " . ", "a__ b", "..x..pdf", "_a._b_.pdf", "Kontoauszug Mai (1).PDF", "Überweisung.pdf"]
+    names += ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for _ in range(2000)]
+
+    for name in names:
+        assert pu.sanitize_filename(name) == reference(name), name
+
+
 def test_build_stable_stem_prefers_id_param():
     url = "https://konto.flatex.at/x?documentId=abc-123"
     assert pu.build_stable_stem(url) == "flatex_abc-123"
 
 
+def test_build_stable_stem_hash_fallback():
+    url = "https://konto.flatex.at/?token=t"
+    stem = pu.build_stable_stem(url)
+    assert stem.startswith("flatex_") and len(stem) == len("flatex_") + 12
+    assert stem != pu.legacy_stable_stem(url)
+
+
+def test_save_pdf_from_link_skips_legacy_hash_name(tmp_path: Path):
+    url = "https://konto.flatex.at/?token=t"
+    legacy = f"{pu.legacy_stable_stem(url)}.pdf"
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(), Dummy(), url, tmp_path, 10, skip_existing=True, existing_names={legacy}
+        )
+    )
+
+    assert result.ok is True
+    assert result.name == legacy
+
+
+def test_save_pdf_from_link_skips_legacy_check_for_named_links(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    def fail_legacy(_url):
+        raise AssertionError("named links never had a SHA-1 stem")
+
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(status=404)
+
+    monkeypatch.setattr(dl, "legacy_stable_stem", fail_legacy)
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+
+    for url in ("https://konto.flatex.at/downloadData/1/a.pdf", "https://konto.flatex.at/?documentId=7"):
+        result = asyncio.run(
+            dl.save_pdf_from_link(Dummy(), Dummy(), url, tmp_path, 10, skip_existing=True, existing_names=set())
+        )
+        assert result.message == "HTTP 404"
+
+
+def test_query_key_priority_ignores_query_order():
+    url = "https://konto.flatex.at/download?id=42&file=&filename=Kontoauszug+Mai.pdf"
+    assert pu.filename_from_url(url, "fallback") == "Kontoauszug_Mai.pdf"
+    assert pu.build_stable_stem("https://konto.flatex.at/x?uuid=u-1&docId=d-2") == "flatex_d-2"
+
+
+def test_parse_url_feeds_every_helper():
+    url = "https://Konto.Flatex.at/download/x.bin?file=&documentId=abc&filename=Kontoauszug+Mai.pdf"
+    info = pu.parse_url(url)
+
+    assert info.host == "konto.flatex.at"
+    assert info.path_tail == "x.bin"
+    assert pu.parse_url(info) is info
+    assert pu.parse_url(url) is info
+    assert pu.is_allowed_download_url(info) is pu.is_allowed_download_url(url) is True
+    assert pu.build_stable_stem(info) == pu.build_stable_stem(url) == "flatex_abc"
+    assert pu.filename_from_url(info, "fallback") == pu.filename_from_url(url, "fallback") == "Kontoauszug_Mai.pdf"
+
+
 def test_is_allowed_download_url():
     assert pu.is_allowed_download_url("https://konto.flatex.at/downloadData/1/a.pdf") is True
     assert pu.is_allowed_download_url("https://konto.flatex.de/downloadData/1/a.pdf") is True
     assert pu.is_allowed_download_url("https://evil.example/a.pdf") is False
 
+    hits = pu.is_allowed_download_url.cache_info().hits
+    assert pu.is_allowed_download_url("https://evil.example/a.pdf") is False
+    assert pu.is_allowed_download_url.cache_info().hits == hits + 1
+
 
 def test_save_pdf_from_link_success(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
-    context = Dummy()
+    client = Dummy()
     page = Dummy()
 
-    def fake_fetch(_context, _link, _timeout):
+    async def fake_fetch(_client, _link, _timeout):
         return FakeResponse(
             headers={
                 "content-type": "application/pdf",
@@ -75,27 +188,339 @@ def test_save_pdf_from_link_success(monkeypatch: pytest.MonkeyPatch, tmp_path: P
 
     monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
 
-    ok, msg, retriable = dl.save_pdf_from_link(
-        context,
-        page,
-        "https://konto.flatex.at/downloadData/1/foo.pdf",
-        tmp_path,
-        10,
-        skip_existing=False,
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://konto.flatex.at/downloadData/1/foo.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
     )
 
-    assert ok is True
-    assert retriable is False
-    assert "saved foo.pdf" in msg
+    assert result.ok is True
+    assert result.retriable is False
+    assert "saved foo.pdf" in result.message
     assert (tmp_path / "foo.pdf").exists()
 
 
+def test_save_pdf_from_link_streams_chunks_to_final_name(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    body = b"%PDF-" + bytes(range(256)) * 600
+    response = FakeResponse(
+        headers={
+            "content-type": "application/pdf",
+            "content-disposition": 'attachment; filename="big.pdf"',
+        },
+        body=body,
+        chunk_size=3,
+    )
+
+    async def fake_fetch(_client, _link, _timeout):
+        return response
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/big.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
+    )
+
+    assert result.ok is True
+    assert result.retriable is False
+    assert "saved big.pdf" in result.message
+    assert response.closed is True
+    assert (tmp_path / "big.pdf").read_bytes() == body
+    assert list(tmp_path.glob("*.part")) == []
+
+
+def test_save_pdf_from_link_suffixes_taken_names(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(
+            headers={
+                "content-type": "application/pdf",
+                "content-disposition": 'attachment; filename="foo.pdf"',
+            },
+        )
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    existing_names = {"foo.pdf", "foo_2.pdf"}
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/foo.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=existing_names,
+        )
+    )
+
+    assert result.ok is True
+    assert "saved foo_3.pdf" in result.message
+    assert existing_names == {"foo.pdf", "foo_2.pdf", "foo_3.pdf"}
+    assert (tmp_path / "foo_3.pdf").exists()
+
+
+@pytest.mark.parametrize("taken", [0, 1, 2, 3, 7, 8, 33])
+def test_next_free_name_finds_end_of_suffix_run(taken: int):
+    existing_names = {"foo.pdf"} | {f"foo_{i}.pdf" for i in range(2, taken + 2)}
+    assert dl._next_free_name("foo.pdf", existing_names) == f"foo_{taken + 2}.pdf"
+
+
+def test_save_pdf_from_link_never_clobbers_files_created_after_listing(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(
+            headers={
+                "content-type": "application/pdf",
+                "content-disposition": 'attachment; filename="foo.pdf"',
+            },
+            body=b"%PDF-new",
+        )
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    (tmp_path / "foo.pdf.part").write_bytes(b"%PDF-in-progress")
+    (tmp_path / "foo_2.pdf").write_bytes(b"%PDF-theirs")
+    existing_names: set[str] = set()
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/foo.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=existing_names,
+        )
+    )
+
+    assert result.name == "foo_3.pdf"
+    assert (tmp_path / "foo.pdf.part").read_bytes() == b"%PDF-in-progress"
+    assert (tmp_path / "foo_2.pdf").read_bytes() == b"%PDF-theirs"
+    assert (tmp_path / "foo_3.pdf").read_bytes() == b"%PDF-new"
+    assert not (tmp_path / "foo_3.pdf.part").exists()
+
+
+def test_publish_falls_back_to_rename_without_hard_links(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    def no_links(_src, _dst):
+        raise PermissionError(errno.EPERM, "hard links not supported")
+
+    monkeypatch.setattr(dl.os, "link", no_links)
+    tmp = tmp_path / "a.pdf.part"
+    tmp.write_bytes(b"%PDF-a")
+
+    dl._publish_no_clobber(tmp, tmp_path / "a.pdf")
+
+    assert [p.name for p in tmp_path.iterdir()] == ["a.pdf"]
+
+
+def test_publish_never_clobbers_on_other_errors(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    def denied(_src, _dst):
+        raise PermissionError(errno.EACCES, "denied")
+
+    monkeypatch.setattr(dl.os, "link", denied)
+    (tmp_path / "a.pdf").write_bytes(b"%PDF-theirs")
+    tmp = tmp_path / "a.pdf.part"
+    tmp.write_bytes(b"%PDF-ours")
+
+    with pytest.raises(PermissionError):
+        dl._publish_no_clobber(tmp, tmp_path / "a.pdf")
+
+    assert (tmp_path / "a.pdf").read_bytes() == b"%PDF-theirs"
+
+
+def test_save_pdf_from_link_reports_vanished_part_as_row_failure(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(headers={"content-type": "application/pdf"}, body=b"%PDF-gone")
+
+    def sweep_then_link(src, dst):
+        os.unlink(src)
+        return real_link(src, dst)
+
+    real_link = os.link
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    monkeypatch.setattr(dl.os, "link", sweep_then_link)
+    existing_names: set[str] = set()
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/gone.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=existing_names,
+            attempts=1,
+        )
+    )
+
+    assert result.ok is False
+    assert result.message.startswith("could not publish gone.pdf")
+    assert existing_names == set()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save_pdf_from_link_rejects_html_after_first_bytes(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    response = FakeResponse(
+        headers={"content-type": "text/html", "content-disposition": 'attachment; filename="login.pdf"'},
+        body=b"<!DOCTYPE html>" + b"x" * 4096,
+        chunk_size=4,
+    )
+
+    async def fake_fetch(_client, _link, _timeout):
+        return response
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    existing_names: set[str] = set()
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/login.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=existing_names,
+        )
+    )
+
+    assert result.ok is False
+    assert result.retriable is False
+    assert result.message == "not a PDF (content-type=text/html)"
+    assert response.chunks_read == 2
+    assert response.closed is True
+    assert existing_names == set()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save_pdf_from_link_accepts_pdf_magic_under_generic_content_type(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(headers={"content-type": "application/octet-stream"}, body=b"%PDF-1.7 body", chunk_size=2)
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/raw.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
+    )
+
+    assert result.ok is True
+    assert (tmp_path / "raw.pdf").read_bytes() == b"%PDF-1.7 body"
+
+
+def test_save_pdf_from_link_interrupted_stream_leaves_no_files(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    class DroppedResponse(FakeResponse):
+        async def aiter_bytes(self, chunk_size: int | None = None):
+            yield b"%PDF-" + b"x" * dl.PDF_CHUNK_SIZE
+            yield b"y" * dl.PDF_CHUNK_SIZE
+            raise dl.httpx.ReadError("connection reset")
+
+    async def fake_fetch(_client, _link, _timeout):
+        return DroppedResponse(headers={"content-type": "application/pdf"})
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    existing_names: set[str] = set()
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/drop.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=existing_names,
+            attempts=1,
+        )
+    )
+
+    assert result.ok is False
+    assert "download interrupted" in result.message
+    assert existing_names == set()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sweep_partial_files_only_removes_stale_part_files(tmp_path: Path):
+    (tmp_path / "a.pdf").write_bytes(b"%PDF-a")
+    (tmp_path / "b.pdf.part").write_bytes(b"%PDF-trunc")
+    (tmp_path / "c.pdf.part").write_bytes(b"")
+    (tmp_path / "live.pdf.part").write_bytes(b"%PDF-still-writing")
+    stale = time.time() - dl.PART_STALE_AFTER - 60
+    for name in ("b.pdf.part", "c.pdf.part"):
+        os.utime(tmp_path / name, (stale, stale))
+
+    assert dl.sweep_partial_files(tmp_path) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.pdf", "live.pdf.part"]
+    assert dl.list_output_names(tmp_path) == {"a.pdf", "live.pdf.part"}
+
+
+def test_save_pdf_from_link_semaphore_bounds_requests_in_flight(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    stats = {"now": 0, "peak": 0}
+
+    async def fake_fetch(_client, link, _timeout):
+        stats["now"] += 1
+        stats["peak"] = max(stats["peak"], stats["now"])
+        await asyncio.sleep(0.01)
+        stats["now"] -= 1
+        return FakeResponse(headers={"content-type": "application/pdf"})
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+
+    async def run() -> list[dl.SaveResult]:
+        semaphore = asyncio.Semaphore(2)
+        existing_names: set[str] = set()
+        return await asyncio.gather(
+            *(
+                dl.save_pdf_from_link(
+                    Dummy(),
+                    Dummy(),
+                    f"https://konto.flatex.at/downloadData/{i}/doc{i}.pdf",
+                    tmp_path,
+                    10,
+                    skip_existing=False,
+                    existing_names=existing_names,
+                    semaphore=semaphore,
+                )
+                for i in range(6)
+            )
+        )
+
+    results = asyncio.run(run())
+
+    assert all(result.ok for result in results)
+    assert stats["peak"] == 2
+
+
 def test_save_pdf_from_link_503_warmup_then_success(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
-    context = Dummy()
+    client = Dummy()
     page = Dummy()
     calls = {"n": 0, "warm": 0}
 
-    def fake_fetch(_context, _link, _timeout):
+    async def fake_fetch(_client, _link, _timeout):
         calls["n"] += 1
         if calls["n"] == 1:
             return FakeResponse(status=503, headers={"content-type": "text/plain"}, body=b"busy")
@@ -107,78 +532,383 @@ def test_save_pdf_from_link_503_warmup_then_success(monkeypatch: pytest.MonkeyPa
             body=b"%PDF-ok",
         )
 
-    def fake_warmup(_page, _link):
+    async def fake_warmup(_page, _link):
         calls["warm"] += 1
 
     monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
     monkeypatch.setattr(dl, "warmup_pdf_link", fake_warmup)
+    monkeypatch.setattr(dl, "backoff_delay", lambda _attempt: 0)
 
-    ok, msg, retriable = dl.save_pdf_from_link(
-        context,
-        page,
-        "https://konto.flatex.at/downloadData/1/ok.pdf",
-        tmp_path,
-        10,
-        skip_existing=False,
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://konto.flatex.at/downloadData/1/ok.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
     )
 
-    assert ok is True
-    assert retriable is False
+    assert result.ok is True
+    assert result.retriable is False
     assert calls["warm"] == 1
-    assert "saved ok.pdf" in msg
+    assert "saved ok.pdf" in result.message
 
 
-def test_save_pdf_from_link_503_warmup_failure_is_retriable(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
-    context = Dummy()
+def test_save_pdf_from_link_503_warmup_failure_exhausts_budget(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    client = Dummy()
     page = Dummy()
+    calls = {"fetch": 0, "warm": 0}
 
-    def fake_fetch(_context, _link, _timeout):
+    async def fake_fetch(_client, _link, _timeout):
+        calls["fetch"] += 1
         return FakeResponse(status=503, headers={"content-type": "text/plain"}, body=b"busy")
 
-    def fake_warmup(_page, _link):
+    async def fake_warmup(_page, _link):
+        calls["warm"] += 1
         raise RuntimeError("iframe-timeout")
 
     monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
     monkeypatch.setattr(dl, "warmup_pdf_link", fake_warmup)
+    monkeypatch.setattr(dl, "backoff_delay", lambda _attempt: 0)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://konto.flatex.at/downloadData/1/slow.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+            attempts=3,
+        )
+    )
+
+    assert result.ok is False
+    assert result.retriable is False
+    assert "503 warm-up failed" in result.message
+    assert calls == {"fetch": 1, "warm": 2}
 
-    ok, msg, retriable = dl.save_pdf_from_link(
-        context,
-        page,
-        "https://konto.flatex.at/downloadData/1/slow.pdf",
-        tmp_path,
-        10,
-        skip_existing=False,
+
+def test_save_pdf_from_link_backs_off_on_429_without_warmup(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    delays = []
+
+    async def fake_fetch(_client, _link, _timeout):
+        return FakeResponse(status=429, headers={"content-type": "text/plain"}, body=b"slow down")
+
+    async def fail_warmup(_page, _link):
+        raise AssertionError("warm-up is only for 503")
+
+    def fake_delay(attempt):
+        delays.append(attempt)
+        return 0
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    monkeypatch.setattr(dl, "warmup_pdf_link", fail_warmup)
+    monkeypatch.setattr(dl, "backoff_delay", fake_delay)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/busy.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+            attempts=4,
+        )
     )
 
-    assert ok is False
-    assert retriable is True
-    assert "503 warm-up failed" in msg
+    assert result.message == "HTTP 429"
+    assert result.retriable is False
+    assert delays == [1, 2, 3]
+    assert all(0 <= dl.backoff_delay(n) <= min(30.0, 0.5 * 2**n) for n in range(10))
+
+
+def test_retry_after_seconds_parses_delta_and_http_date():
+    future = datetime.now(timezone.utc) + timedelta(seconds=90)
+
+    assert dl._retry_after_seconds(FakeResponse(headers={"retry-after": "3"})) == 3.0
+    http_date = format_datetime(future, usegmt=True)
+    assert 80 < dl._retry_after_seconds(FakeResponse(headers={"retry-after": http_date})) <= 90
+    assert dl._retry_after_seconds(FakeResponse(headers={"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert dl._retry_after_seconds(FakeResponse(headers={"retry-after": "soon"})) is None
+    assert dl._retry_after_seconds(FakeResponse(headers={"retry-after": "²"})) is None
+    assert dl._retry_after_seconds(FakeResponse(headers={})) is None
+
+
+def test_save_pdf_from_link_sleeps_for_retry_after(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    sleeps = []
+    calls = {"n": 0}
+
+    async def fake_fetch(_client, _link, _timeout):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            return FakeResponse(status=429, headers={"retry-after": "3"}, body=b"")
+        return FakeResponse(headers={"content-type": "application/pdf"}, body=b"%PDF-ok")
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    monkeypatch.setattr(dl, "backoff_delay", lambda _attempt: 0.25)
+    monkeypatch.setattr(dl.asyncio, "sleep", fake_sleep)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/polite.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
+    )
+
+    assert result.ok is True
+    assert sleeps == [3.0]
+
+
+def test_circuit_breaker_opens_then_lets_one_probe_through(monkeypatch: pytest.MonkeyPatch):
+    now = {"t": 100.0}
+    monkeypatch.setattr(dl.time, "monotonic", lambda: now["t"])
+    breaker = dl.CircuitBreaker(threshold=2, cooldown_s=30.0)
+    host = "konto.flatex.at"
+
+    breaker.record(host, dl.SaveResult(False, "HTTP 502", True, status=502))
+    assert breaker.allow(host) is True
+    breaker.record(host, dl.SaveResult(False, "request failed: boom", True))
+    assert breaker.allow(host) is False
+    assert breaker.allow("konto.flatex.de") is True
+
+    now["t"] += 31
+    assert breaker.allow(host) is True
+    assert breaker.allow(host) is False
+    breaker.record(host, dl.SaveResult(True, "saved a.pdf", False, "a.pdf"))
+    assert breaker.allow(host) is True
+
+
+def test_save_pdf_from_link_short_circuits_when_open(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    async def fail_fetch(_client, _link, _timeout):
+        raise AssertionError("open circuit must not hit the network")
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fail_fetch)
+    breaker = dl.CircuitBreaker(threshold=1)
+    breaker.record_failure("konto.flatex.at")
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/a.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+            breaker=breaker,
+        )
+    )
+
+    assert result == dl.SaveResult(False, "circuit open", True)
+
+
+def _cold_link_fakes(monkeypatch: pytest.MonkeyPatch) -> dict[str, int]:
+    # Every link answers 503 until it has been warmed up once, then serves the PDF.
+    warmed: set[str] = set()
+    calls = {"warm": 0}
+
+    async def fake_fetch(_client, link, _timeout):
+        await asyncio.sleep(0)
+        if link not in warmed:
+            return FakeResponse(status=503, headers={"content-type": "text/plain"}, body=b"busy")
+        return FakeResponse(headers={"content-type": "application/pdf"}, body=b"%PDF-ok")
+
+    async def fake_warmup(_page, link):
+        calls["warm"] += 1
+        warmed.add(link)
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    monkeypatch.setattr(dl, "warmup_pdf_link", fake_warmup)
+    monkeypatch.setattr(dl, "backoff_delay", lambda _attempt: 0)
+    return calls
+
+
+def test_circuit_breaker_ignores_cold_pdf_503s(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    calls = _cold_link_fakes(monkeypatch)
+    breaker = dl.CircuitBreaker()
+
+    async def run():
+        return await asyncio.gather(
+            *(
+                dl.save_pdf_from_link(
+                    Dummy(),
+                    Dummy(),
+                    f"https://konto.flatex.at/downloadData/{i}/cold{i}.pdf",
+                    tmp_path,
+                    10,
+                    skip_existing=False,
+                    existing_names=set(),
+                    breaker=breaker,
+                )
+                for i in range(8)
+            )
+        )
+
+    results = asyncio.run(run())
+
+    assert [result.ok for result in results] == [True] * 8
+    assert calls["warm"] == 8
+    assert breaker.failures == {} and breaker.opened_at == {}
+
+
+def test_circuit_breaker_half_open_probe_may_warm_up_a_cold_link(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    calls = _cold_link_fakes(monkeypatch)
+    now = {"t": 100.0}
+    monkeypatch.setattr(dl.time, "monotonic", lambda: now["t"])
+    breaker = dl.CircuitBreaker(threshold=1, cooldown_s=30.0)
+    breaker.record_failure("konto.flatex.at")
+    now["t"] += 31
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(),
+            Dummy(),
+            "https://konto.flatex.at/downloadData/1/probe.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+            breaker=breaker,
+        )
+    )
+
+    assert result.ok is True
+    assert calls["warm"] == 1
+    assert breaker.allow("konto.flatex.at") is True
+
+
+def test_save_pdf_from_link_warms_up_without_holding_a_network_slot(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    calls = _cold_link_fakes(monkeypatch)
+    mark_warm = dl.warmup_pdf_link
+    events = {}
+
+    async def slow_warmup(page, link):
+        events["started"].set()
+        await events["release"].wait()
+        await mark_warm(page, link)
+
+    monkeypatch.setattr(dl, "warmup_pdf_link", slow_warmup)
+
+    async def run():
+        events.update(started=asyncio.Event(), release=asyncio.Event())
+        semaphore = asyncio.Semaphore(1)
+
+        def save(link: str):
+            return dl.save_pdf_from_link(
+                Dummy(), Dummy(), link, tmp_path, 10, skip_existing=False, existing_names=set(), semaphore=semaphore
+            )
+
+        cold = asyncio.ensure_future(save("https://konto.flatex.at/downloadData/1/cold.pdf"))
+        await events["started"].wait()
+        # The cold link is parked in its warm-up; another link must still get the only slot.
+        warm_link = "https://konto.flatex.at/downloadData/2/warm.pdf"
+        await mark_warm(Dummy(), warm_link)
+        other = await asyncio.wait_for(save(warm_link), timeout=1)
+        events["release"].set()
+        return other, await cold
+
+    other, cold = asyncio.run(run())
+
+    assert other.ok is True
+    assert cold.ok is True
+    assert calls["warm"] == 2
+
+
+def test_save_pdf_from_link_resyncs_cookies_on_403(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    client = Dummy()
+    page = Dummy()
+    page.context = Dummy()
+    calls = {"n": 0, "sync": 0}
+
+    async def fake_fetch(_client, _link, _timeout):
+        calls["n"] += 1
+        if calls["sync"] == 0:
+            return FakeResponse(status=403, headers={"content-type": "text/html"}, body=b"login")
+        return FakeResponse(body=b"%PDF-fresh")
+
+    async def fake_sync(_client, context):
+        assert context is page.context
+        calls["sync"] += 1
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+    monkeypatch.setattr(dl, "sync_cookies", fake_sync)
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://konto.flatex.at/downloadData/1/fresh.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
+    )
+
+    assert result.ok is True
+    assert result.retriable is False
+    assert calls == {"n": 2, "sync": 1}
+    assert "saved fresh.pdf" in result.message
+
+
+def test_prewarm_connection_only_targets_download_hosts():
+    class FakeClient:
+        def __init__(self):
+            self.heads = []
+
+        async def head(self, url, timeout):
+            self.heads.append(url)
+            raise dl.httpx.ConnectError("offline")
+
+    client = FakeClient()
+    asyncio.run(dl.prewarm_connection(client, "https://konto.flatex.at/banking-flatex/documentArchive"))
+    asyncio.run(dl.prewarm_connection(client, "https://evil.example/"))
+
+    assert client.heads == ["https://konto.flatex.at/"]
 
 
 def test_save_pdf_from_link_skip_existing(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
-    context = Dummy()
+    client = Dummy()
     page = Dummy()
 
     existing = tmp_path / "already.pdf"
     existing.write_bytes(b"%PDF-existing")
 
-    def fake_fetch(_context, _link, _timeout):
+    async def fake_fetch(_client, _link, _timeout):
         raise AssertionError("fetch should not be called when skip-existing matches")
 
     monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
 
-    ok, msg, retriable = dl.save_pdf_from_link(
-        context,
-        page,
-        "https://konto.flatex.at/downloadData/1/already.pdf",
-        tmp_path,
-        10,
-        skip_existing=True,
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://konto.flatex.at/downloadData/1/already.pdf",
+            tmp_path,
+            10,
+            skip_existing=True,
+            existing_names={"already.pdf"},
+        )
     )
 
-    assert ok is True
-    assert retriable is False
-    assert msg == "skipped existing already.pdf"
+    assert result.ok is True
+    assert result.retriable is False
+    assert result.message == "skipped existing already.pdf"
 
 
 def test_parse_args_range_and_skip_existing(monkeypatch: pytest.MonkeyPatch):
@@ -199,21 +929,406 @@ def test_parse_args_range_and_skip_existing(monkeypatch: pytest.MonkeyPatch):
     assert args.start_row == 10
     assert args.end_row == 20
     assert args.skip_existing is True
+    assert args.workers == 8
+    assert args.max_concurrency == 5
 
 
 def test_save_pdf_from_link_blocks_non_flatex_host(tmp_path: Path):
-    context = Dummy()
+    client = Dummy()
     page = Dummy()
 
-    ok, msg, retriable = dl.save_pdf_from_link(
-        context,
-        page,
-        "https://evil.example/malware.pdf",
-        tmp_path,
-        10,
-        skip_existing=False,
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            client,
+            page,
+            "https://evil.example/malware.pdf",
+            tmp_path,
+            10,
+            skip_existing=False,
+            existing_names=set(),
+        )
+    )
+
+    assert result.ok is False
+    assert result.retriable is False
+    assert result.message == "blocked non-Flatex download host"
+
+
+def test_flush_logs_periodically_flushes_until_cancelled():
+    class CountingHandler:
+        flushes = 0
+
+        def flush(self) -> None:
+            self.flushes += 1
+
+    handler = CountingHandler()
+
+    async def run() -> None:
+        task = asyncio.create_task(cli.flush_logs_periodically(handler, interval=0.01))
+        await asyncio.sleep(0.055)
+        task.cancel()
+
+    asyncio.run(run())
+
+    assert 2 <= handler.flushes <= 6
+
+
+def test_order_by_host_groups_links_and_keeps_row_order():
+    error = cli.FlatexError("row 1: command HTTP 502", status=502)
+    links = {
+        0: "https://konto.flatex.de/downloadData/0.pdf",
+        1: error,
+        2: "https://konto.flatex.at/downloadData/2.pdf",
+        3: "https://konto.flatex.de/downloadData/3.pdf",
+        4: "https://konto.flatex.at/downloadData/4.pdf",
+    }
+
+    ordered = cli.order_by_host(links)
+
+    assert [row for row, _ in ordered] == [1, 2, 4, 0, 3]
+    assert ordered[0][1] is error
+
+
+def test_process_row_retries_link_resolution(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    calls = {"resolve": 0}
+
+    async def fake_resolve(_page, _state, _row_index):
+        calls["resolve"] += 1
+        if calls["resolve"] == 1:
+            raise cli.FlatexError("row 0: command HTTP 500", status=500)
+        return "https://konto.flatex.at/downloadData/1/foo.pdf"
+
+    async def fake_save(_client, _page, _link, _output_dir, _timeout, _skip_existing, _existing_names, **_names):
+        return dl.SaveResult(True, "saved foo.pdf (1.0 KB)", False, "foo.pdf")
+
+    sleeps = []
+
+    async def no_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(cli, "get_row_pdf_link", fake_resolve)
+    monkeypatch.setattr(cli, "save_pdf_from_link", fake_save)
+    monkeypatch.setattr(cli.asyncio, "sleep", no_sleep)
+    args = Dummy()
+    args.retries = 3
+    args.timeout = 10
+    args.skip_existing = False
+
+    outcome, msg, url, name = asyncio.run(cli.process_row(Dummy(), Dummy(), {}, 0, 1, args, tmp_path, set()))
+
+    assert outcome == "downloaded"
+    assert name == "foo.pdf"
+    assert msg == "saved foo.pdf (1.0 KB)"
+    assert url is None
+    assert calls["resolve"] == 2
+    assert len(sleeps) == 1
+    assert 0.5 <= sleeps[0] <= 1.0
+
+
+@pytest.mark.parametrize(("failed_status", "expected_resolves"), [(503, 1), (410, 2)])
+def test_process_row_reresolves_link_only_when_expired(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, failed_status: int, expected_resolves: int
+):
+    calls = {"resolve": 0, "save": 0}
+
+    async def fake_resolve(_page, _state, _row_index):
+        calls["resolve"] += 1
+        return f"https://konto.flatex.at/downloadData/{calls['resolve']}/foo.pdf"
+
+    async def fake_save(_client, _page, _link, _output_dir, _timeout, _skip_existing, _existing_names, **_names):
+        calls["save"] += 1
+        if calls["save"] == 1:
+            return dl.SaveResult(False, f"HTTP {failed_status}", failed_status == 503, status=failed_status)
+        return dl.SaveResult(True, "saved foo.pdf (1.0 KB)", False, "foo.pdf")
+
+    async def no_sleep(_delay):
+        return None
+
+    monkeypatch.setattr(cli, "get_row_pdf_link", fake_resolve)
+    monkeypatch.setattr(cli, "save_pdf_from_link", fake_save)
+    monkeypatch.setattr(cli.asyncio, "sleep", no_sleep)
+    args = Dummy()
+    args.retries = 3
+    args.timeout = 10
+    args.skip_existing = False
+
+    outcome, _, _, _ = asyncio.run(cli.process_row(Dummy(), Dummy(), {}, 0, 1, args, tmp_path, set()))
+
+    assert outcome == "downloaded"
+    assert calls == {"resolve": expected_resolves, "save": 2}
+
+
+def test_process_row_does_not_sleep_on_parse_errors(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    async def fake_resolve(_page, _state, row_index):
+        raise cli.FlatexError(f"row {row_index}: execute command missing")
+
+    async def fail_sleep(_delay):
+        raise AssertionError("non-retriable errors must not back off")
+
+    monkeypatch.setattr(cli, "get_row_pdf_link", fake_resolve)
+    monkeypatch.setattr(cli.asyncio, "sleep", fail_sleep)
+    args = Dummy()
+    args.retries = 3
+    args.timeout = 10
+    args.skip_existing = False
+
+    outcome, msg, url, name = asyncio.run(cli.process_row(Dummy(), Dummy(), {}, 0, 1, args, tmp_path, set()))
+
+    assert outcome == "failed"
+    assert name is None
+    assert "execute command missing" in msg
+    assert url is None
+
+
+def test_run_task_group_cancels_siblings_on_failure():
+    state = {"cancelled": False}
+
+    async def crash():
+        await asyncio.sleep(0)
+        raise OSError("disk full")
+
+    async def wait_forever():
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    with pytest.raises(OSError, match="disk full"):
+        asyncio.run(cli.run_task_group(crash(), wait_forever()))
+    assert state["cancelled"] is True
+
+
+def test_backoff_grows_exponentially_with_cap():
+    for attempt, upper in ((1, 1.0), (2, 2.0), (3, 4.0), (10, 10.0)):
+        delay = cli._backoff(attempt)
+        assert upper / 2 <= delay <= upper
+
+
+def test_install_page_helpers_covers_current_and_future_documents():
+    class FakePage:
+        def __init__(self):
+            self.init_scripts = []
+            self.evaluated = []
+
+        async def add_init_script(self, script):
+            self.init_scripts.append(script)
+
+        async def evaluate(self, script):
+            self.evaluated.append(script)
+
+    page = FakePage()
+    asyncio.run(ps.install_page_helpers(page))
+
+    assert page.init_scripts == [ps.FLATEX_JS]
+    assert page.evaluated == [ps.FLATEX_INSTALL_JS]
+    assert "window.__flatex_fetchRows" in ps.FLATEX_JS
+    assert "window.__flatex_warmup" in ps.FLATEX_JS
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node to evaluate the page script")
+def test_install_expression_completes_without_running_a_helper():
+    # Mirrors Playwright's UtilityScript: eval the expression, call the result if it is a function.
+    harness = """
+    globalThis.window = globalThis;
+    let frames = 0;
+    globalThis.document = { createElement: () => { frames++; return {}; } };
+    const value = (0, eval)(require('fs').readFileSync(0, 'utf8'));
+    const result = typeof value === 'function' ? value() : value;
+    console.log(JSON.stringify({
+      result: result === undefined ? 'undefined' : typeof result,
+      frames,
+      installed: typeof window.__flatex_warmup === 'function' && typeof window.__flatex_fetchRows === 'function',
+    }));
+    """
+    out = subprocess.run(
+        ["node", "-e", harness], input=ps.FLATEX_INSTALL_JS, capture_output=True, text=True, check=True
+    ).stdout
+
+    assert json.loads(out) == {"result": "undefined", "frames": 0, "installed": True}
+
+
+WARMUP_HARNESS = """
+globalThis.window = globalThis;
+const { heads, iframeEntry } = JSON.parse(process.argv[1]);
+const observers = new Set();
+const emit = (entry) => {
+  for (const cb of observers) cb({ getEntriesByName: (n) => (entry.name === n ? [entry] : []) });
+};
+globalThis.PerformanceObserver = class {
+  constructor(cb) { this.cb = cb; }
+  observe() { observers.add(this.cb); }
+  disconnect() { observers.delete(this.cb); }
+};
+globalThis.setTimeout = (fn) => setImmediate(fn);
+const frame = {
+  style: {}, isConnected: false, addEventListener() {}, removeEventListener() {},
+  set src(v) {
+    if (iframeEntry && v !== 'about:blank') emit({ name: v, initiatorType: 'iframe', responseEnd: 5 });
+  },
+};
+globalThis.document = { createElement: () => frame, body: { appendChild: (f) => { f.isConnected = true; } } };
+let probes = 0;
+globalThis.fetch = async (url) => {
+  const status = heads[Math.min(probes++, heads.length - 1)];
+  // Like a browser, every HEAD leaves a finished resource entry, whatever its status.
+  emit({ name: url, initiatorType: 'fetch', responseEnd: 3 });
+  return { ok: status >= 200 && status < 300, status };
+};
+const install = (0, eval)(require('fs').readFileSync(0, 'utf8'));
+install();
+window.__flatex_warmup('https://konto.flatex.at/downloadData/1/a.pdf')
+  .then(() => console.log(JSON.stringify({ probes })));
+"""
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node to evaluate the page script")
+@pytest.mark.parametrize(
+    ("heads", "iframe_entry", "expected_probes"),
+    [([503, 503, 200], False, 3), ([503], True, 0)],
+)
+def test_warmup_waits_for_pdf_not_for_its_own_probes(heads, iframe_entry, expected_probes):
+    out = subprocess.run(
+        ["node", "-e", WARMUP_HARNESS, json.dumps({"heads": heads, "iframeEntry": iframe_entry})],
+        input=ps.FLATEX_INSTALL_JS,
+        capture_output=True,
+        text=True,
+        check=True,
+        timeout=30,
+    ).stdout
+
+    assert json.loads(out) == {"probes": expected_probes}
+
+
+def test_get_row_pdf_links_maps_batch_payloads_per_row():
+    class FakePage:
+        def __init__(self):
+            self.calls = 0
+
+        async def evaluate(self, _script, arg):
+            self.calls += 1
+            if "rowIndices" not in arg:
+                assert arg["tokenId"] == "t"
+                assert arg["linkPattern"] == pu.PDF_LINK_PATTERN
+                return None
+            assert arg == {"rowIndices": [0, 1, 2], "parallelism": cli.ROW_FETCH_PARALLELISM}
+            if self.calls == 1:
+                return None
+            return [
+                {"rowIndex": 0, "ok": True, "url": "https://konto.flatex.at/downloadData/1/a.pdf"},
+                {"rowIndex": 1, "ok": False, "status": 502, "err": "http"},
+                {"rowIndex": 2, "ok": False, "status": 200, "err": "no-match"},
+            ]
+
+    page = FakePage()
+    state = {
+        "pageUrl": "https://konto.flatex.at/archive",
+        "credentials": {"tokenId": "t", "windowId": "w"},
+        "form": {},
+    }
+
+    links = asyncio.run(cli.get_row_pdf_links(page, state, [0, 1, 2]))
+
+    assert page.calls == 3
+    assert links[0] == "https://konto.flatex.at/downloadData/1/a.pdf"
+    assert isinstance(links[1], cli.FlatexError)
+    assert "command HTTP 502" in str(links[1])
+    assert links[1].retriable is True
+    assert "no PDF link pattern matched" in str(links[2])
+    assert links[2].retriable is False
+
+
+def test_row_keys_leave_repeated_rows_unkeyed():
+    texts = ["01.02.2024 Abrechnung", "01.02.2024 Abrechnung", "Depot"]
+    assert rs.row_keys(texts) == [None, None, "Depot"]
+
+    # A new same-text document above the old ones must not inherit an old row's key.
+    assert rs.row_keys(["01.02.2024 Abrechnung", *texts]) == [None, None, None, "Depot"]
+
+
+def test_resume_log_round_trip(tmp_path: Path):
+    path = tmp_path / rs.RESUME_LOG_NAME
+    log = rs.ResumeLog(path)
+    log.record("row-a", "a.pdf")
+    log.record("row-a", "a.pdf")
+    log.record("row-b", "b.pdf")
+    with path.open("a", encoding="utf-8") as fh:
+        fh.write("not json\n")
+
+    reloaded = rs.ResumeLog(path)
+
+    assert reloaded.name_for("row-a") == "a.pdf"
+    assert reloaded.name_for("row-b") == "b.pdf"
+    assert reloaded.name_for("row-c") is None
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 3
+
+
+def test_manifest_compares_validators_per_document_not_per_filename(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    # Two documents share one generic filename, and Flatex hands out fresh links every run.
+    etags = {"A": '"a1"', "B": '"b1"'}
+
+    async def fake_fetch(_client, link, _timeout):
+        doc = pu.parse_url(link).first(("documentId",))
+        return FakeResponse(
+            headers={
+                "content-type": "application/pdf",
+                "content-disposition": 'attachment; filename="Kontoauszug.pdf"',
+                "etag": etags[doc],
+            },
+            body=f"%PDF-{doc}".encode(),
+        )
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fake_fetch)
+
+    def run(run_no: int) -> list[str]:
+        manifest = rs.ResumeLog(tmp_path / rs.RESUME_LOG_NAME)
+        existing_names = dl.list_output_names(tmp_path)
+        messages = []
+        for doc in ("A", "B"):
+            result = asyncio.run(
+                dl.save_pdf_from_link(
+                    Dummy(),
+                    Dummy(),
+                    f"https://konto.flatex.at/download?documentId={doc}&token=run{run_no}",
+                    tmp_path,
+                    10,
+                    skip_existing=True,
+                    existing_names=existing_names,
+                    manifest=manifest,
+                )
+            )
+            messages.append(result.message)
+        return messages
+
+    run(1)
+    for run_no in (2, 3):
+        assert all(message.startswith("skipped existing") for message in run(run_no))
+    pdfs = sorted(p.name for p in tmp_path.iterdir() if p.suffix == ".pdf")
+    assert pdfs == ["Kontoauszug.pdf", "Kontoauszug_2.pdf"]
+
+    # A real change to one document is saved once as a new version, then skipped again.
+    etags["B"] = '"b2"'
+    assert run(4)[1].startswith("saved Kontoauszug_3.pdf")
+    assert all(message.startswith("skipped existing") for message in run(5))
+    assert (tmp_path / "Kontoauszug_3.pdf").read_bytes() == b"%PDF-B"
+
+
+def test_manifest_skips_known_link_before_any_request(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    async def fail_fetch(_client, _link, _timeout):
+        raise AssertionError("a known link whose file exists needs no request")
+
+    monkeypatch.setattr(dl, "fetch_pdf_response", fail_fetch)
+    manifest = rs.ResumeLog(tmp_path / rs.RESUME_LOG_NAME)
+    link = "https://konto.flatex.at/downloadData/1/a.pdf"
+    manifest.record_link(link, "stmt.pdf", '"v1"', None, pu.build_stable_stem(link))
+
+    result = asyncio.run(
+        dl.save_pdf_from_link(
+            Dummy(), Dummy(), link, tmp_path, 10, skip_existing=True, existing_names={"stmt.pdf"}, manifest=manifest
+        )
     )
 
-    assert ok is False
-    assert retriable is False
-    assert msg == "blocked non-Flatex download host"
+    assert result.message == "skipped existing stmt.pdf (manifest)"
+    assert rs.ResumeLog(tmp_path / rs.RESUME_LOG_NAME).name_for_link(link) == "stmt.pdf"